@@ -10,20 +10,125 @@ Use this pattern when:
     3. the set of objects that can handle a request should be specified
        dynamically.
 """
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class Request(object):
+    """
+    A request of a given kind, carrying whatever data its handler needs.
+    """
+    def __init__(self, kind, data=None):
+        self.kind = kind
+        self.data = data
+
+    def __repr__(self):
+        return 'Request(%r)' % self.kind
+
+
 class Handler(object):
     """
     1. Defines an interface for handling requests.
     2. Optionally implements the successor link.
+
+    A handler either lists the request kinds it accepts in kinds, or leaves
+    kinds as None and overrides can_handle() with its own predicate.
+    Handlers that never accept a request another handler would also accept
+    can set independent, which lets an AdaptiveChain move them around.
     """
+    kinds = None
+    independent = False
+
     def __init__(self, successor=None):
         self._successor = successor
+        self.hits = 0
+        self.misses = 0
 
     def __str__(self):
         return 'Handler'
 
-    def handle_request(self):
+    def successor(self):
+        return self._successor
+
+    def can_handle(self, request):
+        if self.kinds is None:
+            raise NotImplementedError
+        return request.kind in self.kinds
+
+    def probe(self, request, cancelled):
+        """
+        can_handle() as run by a ConcurrentChain. Handlers whose check does
+        slow I/O can override it and give up once the cancelled event is
+        set, which happens when the probe can no longer win.
+        """
+        return self.can_handle(request)
+
+    def handle(self, request):
         raise NotImplementedError
 
+    def handle_request(self, request):
+        if self.can_handle(request):
+            self.hits += 1
+            return self.handle(request)
+        self.misses += 1
+        if self._successor is not None:
+            return self._successor.handle_request(request)
+        else:
+            print 'Could not handle request'
+
+    def handle_batch(self, requests):
+        """
+        Handles the requests this handler can take and returns a list of
+        booleans telling which ones it took. Override it to take a whole
+        batch in one step; by default it goes one request at a time.
+
+        A handler that only overrides handle_request() gets every request
+        passed to it, one at a time, and forwards the ones it can't take
+        down the chain itself; it's then reported as taking them all.
+        """
+        if type(self).handle_request.im_func is not \
+                Handler.handle_request.im_func:
+            for request in requests:
+                self.handle_request(request)
+            return [True] * len(requests)
+        taken = map(self.can_handle, requests)
+        for request, take in zip(requests, taken):
+            if take:
+                self.handle(request)
+        return taken
+
+    def count(self, taken):
+        """
+        Adds the outcome of a batch of can_handle() checks to the counters.
+        """
+        hits = sum(1 for take in taken if take)
+        self.hits += hits
+        self.misses += len(taken) - hits
+
+    def handle_requests(self, batch):
+        """
+        Pushes a batch down the chain: each handler takes what it can in a
+        single handle_batch() call and only the remainder goes on to its
+        successor. Returns the handler that took each request, or None.
+        """
+        takers = [None] * len(batch)
+        pending = range(len(batch))
+        handler = self
+        while handler is not None and pending:
+            taken = handler.handle_batch([batch[i] for i in pending])
+            handler.count(taken)
+            remainder = []
+            for i, take in zip(pending, taken):
+                if take:
+                    takers[i] = handler
+                else:
+                    remainder.append(i)
+            pending = remainder
+            handler = handler.successor()
+        return takers
+
 
 class ConcreteHandler1(Handler):
     """
@@ -32,31 +137,251 @@ class ConcreteHandler1(Handler):
     3. if the ConcreteHandler can handle the request, it does so;
        otherwise it forwards the request to its successor.
     """
-    def handle_request(self, handle=False):
-        if handle:
-            print 'Request handled by: %s' % type(self)
-        elif self._successor is not None:
-            self._successor.handle_request()
-        else:
-            print 'Could not handle request'
+    kinds = ('print',)
+    independent = True
+
+    def handle(self, request):
+        print 'Request handled by: %s' % type(self)
+
+    def handle_batch(self, requests):
+        taken = [request.kind in self.kinds for request in requests]
+        print '%d requests handled by: %s' % (sum(taken), type(self))
+        return taken
 
 
 class ConcreteHandler2(Handler):
-    def handle_request(self, handle=False):
-        if handle:
-            print 'Request handled by: %s' % type(self)
-        elif self._successor is not None:
-            self._successor.handle_request()
+    def can_handle(self, request):
+        return request.data is not None
+
+    def handle(self, request):
+        print 'Request handled by: %s' % type(self)
+
+
+class CompiledChain(object):
+    """
+    Flattens a chain into a table keyed by request kind, so routing doesn't
+    walk the successor links one call at a time. Each kind maps to the
+    predicate handlers that come before the first handler listing that
+    kind, followed by that handler; those are tried in order, which keeps
+    the first match in chain order the winner. Kinds no handler lists fall
+    back to trying every predicate handler, iteratively.
+
+    Routing only counts the requests taken at each position of the chain
+    (the last count is for requests nobody took), one increment each.
+    statistics() adds those to the handlers' hits and misses as if the
+    chain had been walked: a miss for every handler before the taker.
+    """
+    def __init__(self, handler):
+        self._handlers = []
+        self._positions = dict()
+        while handler is not None:
+            if id(handler) in self._positions:
+                raise Exception('Chain has a cycle at: %s' % handler)
+            self._positions[id(handler)] = len(self._handlers)
+            self._handlers.append(handler)
+            handler = handler.successor()
+        self._taken = [0] * (len(self._handlers) + 1)
+
+        self._routes = dict()
+        predicates = []
+        for handler in self._handlers:
+            if handler.kinds is None:
+                predicates.append(handler)
+                continue
+            for kind in handler.kinds:
+                if kind not in self._routes:
+                    self._routes[kind] = (tuple(predicates), handler)
+        self._fallback = (tuple(predicates), None)
+
+    def handlers(self):
+        return list(self._handlers)
+
+    def route(self, request):
+        """
+        Returns the handler the request would be handled by, or None.
+        """
+        predicates, handler = self._routes.get(request.kind, self._fallback)
+        for predicate in predicates:
+            if predicate.can_handle(request):
+                handler = predicate
+                break
+        self._taken[self._positions.get(id(handler), -1)] += 1
+        return handler
+
+    def statistics(self):
+        """
+        Adds the requests routed since the last call to the handlers'
+        counters and returns (handler, hits, misses) for every handler, in
+        chain order.
+        """
+        taken, self._taken = self._taken, [0] * len(self._taken)
+        # Requests taken further down the chain, or not at all
+        later = taken[-1]
+        for position in xrange(len(self._handlers) - 1, -1, -1):
+            handler = self._handlers[position]
+            handler.hits += taken[position]
+            handler.misses += later
+            later += taken[position]
+        return [(h, h.hits, h.misses) for h in self._handlers]
+
+    def handle_request(self, request):
+        handler = self.route(request)
+        if handler is not None:
+            return handler.handle(request)
+        print 'Could not handle request'
+
+
+class ConcurrentChain(object):
+    """
+    Runs the can_handle() checks of a chain concurrently on a thread pool,
+    for handlers that have to do I/O to decide. Up to width handlers are
+    probed at once, but answers are read in chain order, so the first
+    handler in the chain that accepts the request still wins. As soon as
+    the winner is known the remaining probes are cancelled.
+
+    Cancelling only sets an event: a losing probe that ignores it keeps its
+    pool thread busy until it returns, and later requests queue behind it.
+    The timeout bounds how long a request waits for its answer, not how
+    long such a thread stays blocked.
+    """
+    def __init__(self, handler, width=4, timeout=None, pool=None):
+        # Routes are counted in the compiled chain's table
+        self._chain = CompiledChain(handler)
+        self._handlers = self._chain.handlers()
+        self._width = max(1, min(width, len(self._handlers)))
+        self._timeout = timeout
+        self._pool = pool if pool is not None else ThreadPool(self._width)
+
+    def route(self, request, timeout=None):
+        """
+        Returns the handler the request would be handled by, or None. Raises
+        multiprocessing.TimeoutError if that isn't known within timeout
+        seconds.
+        """
+        timeout = timeout if timeout is not None else self._timeout
+        deadline = time.time() + timeout if timeout is not None else None
+        cancelled = threading.Event()
+        try:
+            for start in xrange(0, len(self._handlers), self._width):
+                window = self._handlers[start:start + self._width]
+                probes = [self._pool.apply_async(h.probe, (request, cancelled))
+                          for h in window]
+                for position, probe in enumerate(probes, start):
+                    if deadline is None:
+                        # A bare get() can't be interrupted in Python 2
+                        accepted = probe.get(sys.maxint)
+                    else:
+                        accepted = probe.get(max(0, deadline - time.time()))
+                    if accepted:
+                        self._chain._taken[position] += 1
+                        return self._handlers[position]
+            self._chain._taken[-1] += 1
+            return None
+        finally:
+            cancelled.set()
+
+    def handle_request(self, request, timeout=None):
+        handler = self.route(request, timeout)
+        if handler is not None:
+            return handler.handle(request)
+        print 'Could not handle request'
+
+    def statistics(self):
+        """
+        Same as CompiledChain.statistics().
+        """
+        return self._chain.statistics()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+class AdaptiveChain(object):
+    """
+    Keeps the handlers that accept the most requests at the front of the
+    chain. Every interval requests, each run of consecutive independent
+    handlers is sorted by hits and the successor links are rewired to the
+    new order. Handlers that aren't independent never move, and nothing
+    moves past them, so the first match in chain order still wins.
+
+    Reordering changes the head of the chain. References to the old head,
+    and CompiledChains or ConcurrentChains built from it, keep routing from
+    their old position; use head() (which reorder() also returns) instead.
+    """
+    def __init__(self, handler, interval=1000):
+        self._handlers = CompiledChain(handler).handlers()
+        self._interval = interval
+        self._requests = 0
+
+    def head(self):
+        return self._handlers[0] if self._handlers else None
+
+    def handle_request(self, request):
+        self._requests += 1
+        if self._requests % self._interval == 0:
+            self.reorder()
+
+        handler = self.head()
+        while handler is not None:
+            if handler.can_handle(request):
+                handler.hits += 1
+                return handler.handle(request)
+            handler.misses += 1
+            handler = handler.successor()
+        print 'Could not handle request'
+
+    def reorder(self):
+        handlers, run = [], []
+        for handler in self._handlers + [None]:
+            if handler is not None and handler.independent:
+                run.append(handler)
+                continue
+            # sorted() is stable, so ties keep their order
+            handlers.extend(sorted(run, key=lambda h: -h.hits))
+            run = []
+            if handler is not None:
+                handlers.append(handler)
+
+        for handler, successor in zip(handlers, handlers[1:] + [None]):
+            handler._successor = successor
+        self._handlers = handlers
+        return self.head()
+
+    def statistics(self):
+        """
+        Returns (handler, hits, misses) for every handler, in chain order.
+        """
+        return [(h, h.hits, h.misses) for h in self._handlers]
 
 
 class Client(object):
     def main(self):
         h1 = ConcreteHandler1()
-        h1.handle_request(True)
+        h1.handle_request(Request('print'))
 
         h2 = ConcreteHandler2(h1)
-        h2.handle_request(True)
-        h2.handle_request(False)
+        h2.handle_request(Request('save', 'data'))
+        h2.handle_request(Request('print'))
+        h2.handle_request(Request('save'))
+
+        chain = CompiledChain(h2)
+        chain.handle_request(Request('print'))
+        chain.handle_request(Request('save'))
+
+        batch = [Request('print'), Request('save', 'data'), Request('save')]
+        for request, handler in zip(batch, h2.handle_requests(batch)):
+            print '%s taken by: %s' % (request, type(handler))
+
+        chain = AdaptiveChain(h2, interval=2)
+        chain.handle_request(Request('print'))
+        chain.handle_request(Request('print'))
+        for handler, hits, misses in chain.statistics():
+            print '%s: %d hits, %d misses' % (type(handler), hits, misses)
+
+        chain = ConcurrentChain(chain.head(), timeout=1)
+        chain.handle_request(Request('save', 'data'))
+        chain.close()
 
 
 if __name__ == '__main__':
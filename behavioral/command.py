@@ -32,6 +32,23 @@ Use this pattern when you want to:
        way. The pattern also makes it easy to extend the system with new
        transactions.
 """
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import zlib
+from collections import deque
+from itertools import chain
+from Queue import Full
+
+
 class Command(object):
     """
     Declares an interface for executing an operation.
@@ -43,6 +60,36 @@ class Command(object):
     def execute(self):
         raise NotImplementedError
 
+    def unexecute(self):
+        """
+        Reverses the effects of the last execute(), using the state it left
+        in self.state.
+        """
+        raise NotImplementedError
+
+    def merge(self, other):
+        """
+        Returns a single command with the same effect as executing this
+        command and then other, or None if the two can't be merged (the
+        default). Used by a coalescing QueuedInvoker.
+        """
+        return None
+
+    def store(self):
+        """
+        Returns the list of constructor arguments, after the receiver, that
+        a CommandLog writes for this command. They must be JSON
+        serializable. Commands that take arguments override it.
+        """
+        return []
+
+    @classmethod
+    def load(cls, receiver, args):
+        """
+        Rebuilds a command read back from a CommandLog.
+        """
+        return cls(receiver, *args)
+
 
 class ConcreteCommand(Command):
     """
@@ -51,7 +98,7 @@ class ConcreteCommand(Command):
        Receiver.
     """
     def execute(self):
-        self.receiver.action()
+        return self.receiver.action()
 
 
 class Receiver(object):
@@ -63,6 +110,52 @@ class Receiver(object):
         print 'Hello, World!'
 
 
+class Registry(object):
+    """
+    Names receivers, so commands can refer to them independently of the
+    address space. Every process creates its own receiver from the
+    registered factory the first time a command needs it. Factories must be
+    registered before a ProcessInvoker starts its pool, so that the worker
+    processes inherit them.
+    """
+    _factories = dict()
+    _receivers = dict()
+
+    @classmethod
+    def register(cls, key, factory):
+        cls._factories[key] = factory
+        cls._receivers.pop(key, None)
+
+    @classmethod
+    def receiver(cls, key):
+        if key not in cls._receivers:
+            cls._receivers[key] = cls._factories[key]()
+        return cls._receivers[key]
+
+
+class RemoteCommand(Command):
+    """
+    A command whose receiver is a Registry key and whose action is the name
+    of a receiver method, called with args. It can be pickled and executed
+    in another process.
+    """
+    def __init__(self, receiver, action, *args):
+        super(RemoteCommand, self).__init__(receiver)
+        self.action = action
+        self.args = args
+
+    def execute(self):
+        return getattr(Registry.receiver(self.receiver), self.action)(*self.args)
+
+    def store(self):
+        return [self.receiver, self.action] + list(self.args)
+
+    @classmethod
+    def load(cls, receiver, args):
+        # The receiver is the Registry key that was stored with the command
+        return cls(*args)
+
+
 class Client(object):
     """
     Creates a ConcreteCommand object and sets its receiver.
@@ -75,18 +168,828 @@ class Client(object):
 class Invoker(object):
     """
     Asks the command to carry out the request.
+
+    With a CommandLog, the command is written to the log, and the log
+    committed, before it's executed.
     """
-    def __init__(self):
+    def __init__(self, log=None):
         self._command = None
+        self._log = log
 
     def storeCommand(self, command):
         self._command = command
 
     def operation(self):
-        self._command.execute()
+        if self._log is not None:
+            self._log.wait(self._log.append(self._command))
+        return self._command.execute()
+
+
+class History(object):
+    """
+    Executed commands, for undo and redo. It's a ring buffer: once it holds
+    more than maxlen commands, or their undo state takes more than about
+    maxbytes, the oldest ones are forgotten. Both limits cover the commands
+    that can be redone as well. Undo state is taken out of the commands
+    while they sit in the history, compressed if compress is set, and
+    handed back right before unexecute(). Undo and redo are O(1).
+    """
+    def __init__(self, maxlen=None, maxbytes=None, compress=False):
+        self._maxlen = maxlen
+        self._maxbytes = maxbytes
+        self._compress = compress
+        self._done = deque()
+        self._undone = deque()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._done)
+
+    def size(self):
+        """
+        Returns the approximate number of bytes held by the undo history.
+        """
+        return self._bytes
+
+    def _pack(self, command):
+        state, command.state = command.state, None
+        if self._compress:
+            state = zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+        return command, state, sys.getsizeof(state) + sys.getsizeof(command)
+
+    def _unpack(self, entry):
+        command, state, size = entry
+        if self._compress:
+            state = pickle.loads(zlib.decompress(state))
+        command.state = state
+        return command
+
+    def _push(self, command):
+        entry = self._pack(command)
+        self._done.append(entry)
+        self._bytes += entry[2]
+        while (self._maxlen is not None and
+               len(self._done) + len(self._undone) > self._maxlen) or \
+                (self._maxbytes is not None and self._bytes > self._maxbytes):
+            # The oldest undo goes first, then the furthest redo
+            entries = self._done or self._undone
+            if not entries:
+                break
+            self._bytes -= entries.popleft()[2]
+
+    def execute(self, command):
+        """
+        Executes a new command. Whatever could be redone is forgotten.
+        """
+        result = command.execute()
+        while self._undone:
+            self._bytes -= self._undone.pop()[2]
+        self._push(command)
+        return result
+
+    def undo(self):
+        if not self._done:
+            return False
+        entry = self._done.pop()
+        command = self._unpack(entry)
+        command.unexecute()
+        # The entry stays packed, and counted, until it's redone
+        command.state = None
+        self._undone.append(entry)
+        return True
+
+    def redo(self):
+        if not self._undone:
+            return False
+        command, state, size = self._undone.pop()
+        self._bytes -= size
+        command.execute()
+        self._push(command)
+        return True
+
+
+class ProcessInvoker(Invoker):
+    """
+    Executes stored commands on a pool of processes, so CPU bound receivers
+    aren't limited to one core. Commands are sent in batches of batch
+    commands, and operation() returns an iterator over their results, in
+    order, which yields each batch as soon as it's done. Commands and
+    results are pickled, so use RemoteCommand or other commands that don't
+    hold their receiver directly.
+    """
+    def __init__(self, processes=None, batch=256):
+        super(ProcessInvoker, self).__init__()
+        self._pool = multiprocessing.Pool(processes)
+        self._batch = batch
+        self._commands = []
+
+    def storeCommand(self, command):
+        self._commands.append(command)
+
+    def operation(self):
+        commands, self._commands = self._commands, []
+        batches = [commands[i:i + self._batch]
+                   for i in xrange(0, len(commands), self._batch)]
+        return chain.from_iterable(self._pool.imap(_execute_batch, batches))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+class Future(object):
+    """
+    The pending result of a command queued on a QueuedInvoker.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise multiprocessing.TimeoutError()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise multiprocessing.TimeoutError()
+        return self._exception
+
+    def _resolve(self, result=None, exception=None):
+        self._result = result
+        self._exception = exception
+        self._done.set()
+
+
+class QueuedInvoker(Invoker):
+    """
+    Accepts many commands into a bounded queue and executes them on a pool
+    of worker threads, or of processes when processes is set (commands and
+    their receivers are then pickled, so the receiver that runs is a copy).
+    storeCommand() returns a Future. When the queue is full it blocks, or
+    raises Queue.Full right away if block is False. With a CommandLog,
+    accepted commands are logged in queue order and each one waits for its
+    group to be committed before it runs.
+
+    With coalesce set, a new command is merged (see Command.merge()) into
+    the last queued one when possible, so runs of mergeable commands are
+    executed once; all their futures get the merged command's result.
+    """
+    def __init__(self, workers=4, maxsize=1024, processes=False, log=None,
+                 coalesce=False):
+        super(QueuedInvoker, self).__init__(log)
+        self._coalesce = coalesce
+        self._queue = deque()
+        self._maxsize = maxsize
+        self._lock = threading.Condition()
+        self._unfinished = 0
+        self._closed = False
+        self._pool = multiprocessing.Pool(workers) if processes else None
+
+        self._started = time.time()
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._merged = 0
+        self._latency = 0.0
+        self._max_latency = 0.0
+
+        self._workers = [threading.Thread(target=self._work)
+                         for i in xrange(workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def storeCommand(self, command, block=True, timeout=None):
+        future = Future()
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            if self._closed:
+                raise Exception('Invoker is closed')
+            while len(self._queue) >= self._maxsize:
+                remaining = deadline - time.time() if deadline else None
+                if not block or (remaining is not None and remaining <= 0):
+                    self._rejected += 1
+                    raise Full()
+                self._lock.wait(remaining)
+            sequence = self._log.append(command) if self._log else None
+            self._submitted += 1
+            self._unfinished += 1
+            if self._coalesce and self._queue:
+                last, futures, submitted, logged = self._queue[-1]
+                merged = last.merge(command)
+                if merged is not None:
+                    # The log still holds both, which replay the same way
+                    futures.append(future)
+                    self._queue[-1] = (merged, futures, submitted, sequence)
+                    self._merged += 1
+                    return future
+            self._queue.append((command, [future], time.time(), sequence))
+            self._lock.notify_all()
+        return future
+
+    def operation(self):
+        """
+        Waits until every queued command has been executed.
+        """
+        with self._lock:
+            while self._unfinished:
+                self._lock.wait()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._lock.wait()
+                if not self._queue:
+                    return
+                command, futures, submitted, sequence = self._queue.popleft()
+                self._lock.notify_all()
+
+            result, exception = None, None
+            try:
+                if sequence is not None:
+                    self._log.wait(sequence)
+                if self._pool is not None:
+                    result = self._pool.apply(_execute, (command,))
+                else:
+                    result = command.execute()
+            except Exception as e:
+                exception = e
+            for future in futures:
+                future._resolve(result, exception)
+
+            latency = time.time() - submitted
+            with self._lock:
+                self._completed += len(futures)
+                self._failed += len(futures) if exception else 0
+                self._latency += latency * len(futures)
+                self._max_latency = max(self._max_latency, latency)
+                self._unfinished -= len(futures)
+                self._lock.notify_all()
+
+    def metrics(self):
+        with self._lock:
+            elapsed = time.time() - self._started
+            return {
+                'depth': len(self._queue),
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+                'merged': self._merged,
+                'throughput': self._completed / elapsed if elapsed else 0.0,
+                'latency': self._latency / self._completed
+                           if self._completed else 0.0,
+                'max_latency': self._max_latency,
+            }
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        for worker in self._workers:
+            worker.join()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+
+class Timer(object):
+    """
+    A command scheduled on a TimerWheel. Deadline and interval are counted
+    in ticks.
+    """
+    __slots__ = ('command', 'deadline', 'interval', 'cancelled')
+
+    def __init__(self, command, deadline, interval=None):
+        self.command = command
+        self.deadline = deadline
+        self.interval = interval
+        self.cancelled = False
+
+
+class TimerWheel(object):
+    """
+    Schedules delayed and periodic commands on a hierarchical timing wheel.
+    Level 0 has a slot per tick, and each slot of level n covers a whole
+    turn of level n - 1. A timer goes into the lowest level whose turn
+    covers its deadline, and moves down a level (cascades) when the wheel
+    below starts the turn it belongs to. Scheduling and cancelling are O(1);
+    cancelled timers are only flagged, and dropped when their slot comes up.
+
+    Due commands are collected by advance() and handed to the executor (any
+    Invoker with storeCommand(), e.g. a QueuedInvoker) as one batch; without
+    one they are executed right away.
+    """
+    def __init__(self, tick=0.01, slots=256, levels=4, executor=None):
+        self._tick = tick
+        self._slots = slots
+        self._levels = levels
+        self._wheels = [[[] for s in xrange(slots)] for l in xrange(levels)]
+        self._executor = executor
+        self._now = 0
+        self._started = time.time()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def __len__(self):
+        return self._pending
+
+    def schedule(self, command, delay, interval=None):
+        """
+        Runs command after delay seconds and then, if interval is given,
+        every interval seconds until the returned timer is cancelled.
+        """
+        delay = max(1, int(math.ceil(float(delay) / self._tick)))
+        if interval is not None:
+            interval = max(1, int(math.ceil(float(interval) / self._tick)))
+        with self._lock:
+            timer = Timer(command, self._now + delay, interval)
+            self._insert(timer)
+            self._pending += 1
+        return timer
+
+    def cancel(self, timer):
+        with self._lock:
+            if not timer.cancelled:
+                timer.cancelled = True
+                self._pending -= 1
+
+    def _insert(self, timer):
+        delta = timer.deadline - self._now
+        span = 1
+        for level in xrange(self._levels):
+            if delta < span * self._slots:
+                break
+            span *= self._slots
+        else:
+            # Beyond the last wheel: park it in the last slot to come up,
+            # from where it's placed again
+            level = self._levels - 1
+            span //= self._slots
+            slot = (self._now // span - 1) % self._slots
+            self._wheels[level][slot].append(timer)
+            return
+        self._wheels[level][timer.deadline // span % self._slots].append(timer)
+
+    def _turn(self, due):
+        # Moves the clock one tick forward, collecting the timers due then
+        self._now += 1
+        span = self._slots ** (self._levels - 1)
+        for level in xrange(self._levels - 1, 0, -1):
+            if self._now % span == 0:
+                slot = self._wheels[level][self._now // span % self._slots]
+                timers = slot[:]
+                del slot[:]
+                for timer in timers:
+                    if not timer.cancelled:
+                        self._insert(timer)
+            span //= self._slots
+
+        slot = self._wheels[0][self._now % self._slots]
+        timers = slot[:]
+        del slot[:]
+        for timer in timers:
+            if timer.cancelled:
+                continue
+            due.append(timer.command)
+            if timer.interval is not None:
+                timer.deadline += timer.interval
+                self._insert(timer)
+            else:
+                timer.cancelled = True
+                self._pending -= 1
+
+    def advance(self, now=None):
+        """
+        Fires every timer due up to now (the current time by default) and
+        returns how many fired.
+        """
+        now = time.time() if now is None else now
+        due = []
+        with self._lock:
+            target = int((now - self._started) / self._tick)
+            while self._now < target:
+                self._turn(due)
+
+        if self._executor is not None:
+            for command in due:
+                self._executor.storeCommand(command)
+        else:
+            for command in due:
+                command.execute()
+        return len(due)
+
+    def start(self):
+        """
+        Advances the wheel from a background thread, once per tick.
+        """
+        def run():
+            while not self._stopped.wait(self._tick):
+                self.advance()
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class CommandLog(object):
+    """
+    Append-only log of commands, kept as segment files in a directory and
+    written ahead of their execution. Records are committed in groups: a
+    committer thread writes and fsyncs everything appended within latency
+    seconds, or as soon as group records are waiting, so concurrent commands
+    share a single fsync. With group set to 1 every append is synced on its
+    own, and with sync False the log is flushed but never synced.
+
+    checkpoint() marks the commands whose effects are saved elsewhere (e.g.
+    in a snapshot) and deletes the segments that only hold those, so the
+    log replayed by recover() stays short.
+    """
+    def __init__(self, directory, group=64, latency=0.002, segment=65536,
+                 sync=True):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._directory = directory
+        self._group = group
+        self._latency = latency
+        self._segment = segment
+        self._sync = sync
+
+        self._checkpoint = self._read_checkpoint()
+        self._sequence = self._checkpoint
+        segments = self._segments()
+        if segments:
+            self._truncate(segments[-1])
+        for name in self._segments():
+            for record in self._records(name):
+                self._sequence = max(self._sequence, record['seq'])
+        self._committed = self._sequence
+        self._file = None
+        self._count = 0
+        self._pending = []
+        self._lock = threading.Condition()
+        self._closed = False
+
+        self._committer = None
+        if group > 1:
+            self._committer = threading.Thread(target=self._run)
+            self._committer.daemon = True
+            self._committer.start()
+
+    def _path(self, name):
+        return os.path.join(self._directory, name)
+
+    def _segments(self):
+        # Segments are named after their first sequence number, zero padded
+        return sorted(n for n in os.listdir(self._directory)
+                      if n.endswith('.log'))
+
+    def _records(self, name):
+        with open(self._path(name)) as segment:
+            for number, line in enumerate(segment, 1):
+                if not line.endswith('\n'):
+                    # Still being written, or torn by a crash
+                    return
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    raise Exception('Corrupt record in %s at line %d' %
+                                    (name, number))
+
+    def _truncate(self, name):
+        # Cuts a write torn by a crash off the end of the last segment, so
+        # new records aren't appended to it. The segment is removed if
+        # nothing else is left.
+        with open(self._path(name), 'rb+') as segment:
+            end = 0
+            line = segment.readline()
+            while line:
+                try:
+                    json.loads(line)
+                    torn = not line.endswith('\n')
+                except ValueError:
+                    torn = True
+                if torn:
+                    if segment.readline():
+                        raise Exception('Corrupt record in %s at offset %d' %
+                                        (name, end))
+                    break
+                end = segment.tell()
+                line = segment.readline()
+            segment.truncate(end)
+            segment.flush()
+            os.fsync(segment.fileno())
+        if not end:
+            os.remove(self._path(name))
+
+    def _read_checkpoint(self):
+        try:
+            with open(self._path('checkpoint')) as checkpoint:
+                return int(checkpoint.read())
+        except IOError:
+            return 0
+
+    def append(self, command):
+        """
+        Logs the command and returns its sequence number, to be passed to
+        wait() before the command is executed.
+        """
+        with self._lock:
+            if self._closed:
+                raise Exception('Log is closed')
+            self._sequence += 1
+            line = json.dumps({'seq': self._sequence,
+                               'command': type(command).__name__,
+                               'args': command.store()})
+            if self._committer is None:
+                self._write([(self._sequence, line)])
+                self._committed = self._sequence
+            else:
+                self._pending.append((self._sequence, line))
+                self._lock.notify_all()
+            return self._sequence
+
+    def wait(self, sequence):
+        """
+        Blocks until the record with the given sequence number is committed.
+        """
+        with self._lock:
+            while self._committed < sequence:
+                self._lock.wait()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._lock.wait()
+                if not self._pending:
+                    return
+                # Give the group until the latency budget runs out to fill up
+                deadline = time.time() + self._latency
+                while len(self._pending) < self._group and not self._closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._lock.wait(remaining)
+                batch, self._pending = self._pending, []
+
+            self._write(batch)
+            with self._lock:
+                self._committed = batch[-1][0]
+                self._lock.notify_all()
+
+    def _write(self, batch):
+        for sequence, line in batch:
+            if self._file is None or self._count >= self._segment:
+                self._rotate(sequence)
+            self._file.write(line + '\n')
+            self._count += 1
+        self._file.flush()
+        if self._sync:
+            os.fsync(self._file.fileno())
+
+    def _rotate(self, sequence):
+        if self._file is not None:
+            # The records written to it since the last sync are part of the
+            # group being committed
+            self._file.flush()
+            if self._sync:
+                os.fsync(self._file.fileno())
+            self._file.close()
+        # Every log starts a new segment, which must not exist yet
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND
+        descriptor = os.open(self._path('%020d.log' % sequence), flags)
+        self._file = os.fdopen(descriptor, 'a')
+        self._count = 0
+
+    def checkpoint(self, sequence):
+        """
+        Records that every command up to sequence no longer needs to be
+        replayed, then deletes the segments holding nothing newer. The log
+        can't tell which committed commands have been executed (a
+        QueuedInvoker runs them later, possibly out of order), so sequence
+        must be that of the last command reflected in the saved state.
+        """
+        with self._lock:
+            if sequence > self._committed:
+                raise Exception('Checkpoint past the last committed command')
+            current = os.path.basename(self._file.name) if self._file else None
+
+        temporary = self._path('checkpoint.tmp')
+        with open(temporary, 'w') as checkpoint:
+            checkpoint.write(str(sequence))
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.rename(temporary, self._path('checkpoint'))
+        self._checkpoint = sequence
+
+        segments = self._segments()
+        for name, following in zip(segments, segments[1:]):
+            if name != current and int(following[:-4]) <= sequence + 1:
+                os.remove(self._path(name))
+
+    def replay(self, commands, receiver):
+        """
+        Yields the logged commands newer than the last checkpoint, rebuilt
+        with Command.load(). commands maps command class names to classes.
+        """
+        for name in self._segments():
+            for record in self._records(name):
+                if record['seq'] > self._checkpoint:
+                    yield commands[record['command']].load(receiver,
+                                                           record['args'])
+
+    def recover(self, commands, receiver):
+        """
+        Re-executes the logged commands after a crash and returns how many
+        there were.
+        """
+        count = 0
+        for command in self.replay(commands, receiver):
+            command.execute()
+            count += 1
+        return count
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        if self._committer is not None:
+            self._committer.join()
+        if self._file is not None:
+            self._file.close()
+
+
+def _execute(command):
+    # Runs in a pool process
+    return command.execute()
+
+
+def _execute_batch(commands):
+    # Runs in a pool process
+    return [command.execute() for command in commands]
+
+
+class Benchmark(object):
+    class Receiver(object):
+        def action(self):
+            pass
+
+    class Edit(Command):
+        # Overwrites one char of a document, a list of chars
+        def __init__(self, receiver, position, char):
+            super(Benchmark.Edit, self).__init__(receiver)
+            self.position = position
+            self.char = char
+
+        def execute(self):
+            self.state = self.receiver[self.position]
+            self.receiver[self.position] = self.char
+
+        def unexecute(self):
+            self.receiver[self.position] = self.state
+
+        def store(self):
+            return [self.position, self.char]
+
+    class Set(Command):
+        # Sets the receiver's value; of a run of these only the last counts
+        def __init__(self, receiver, value):
+            super(Benchmark.Set, self).__init__(receiver)
+            self.value = value
+
+        def execute(self):
+            self.receiver.value = self.value
+            self.receiver.calls += 1
+
+        def store(self):
+            return [self.value]
+
+        def merge(self, other):
+            if isinstance(other, Benchmark.Set) and \
+                    other.receiver is self.receiver:
+                return other
+            return None
+
+    def coalesce(self, count=50000):
+        for coalesce in (False, True):
+            receivers = [self.Receiver() for n in xrange(4)]
+            for receiver in receivers:
+                receiver.value = receiver.calls = 0
+            invoker = QueuedInvoker(workers=1, coalesce=coalesce)
+            started = time.time()
+            for n in xrange(count):
+                invoker.storeCommand(self.Set(receivers[n // 100 % 4], n))
+            invoker.operation()
+            elapsed = time.time() - started
+            invoker.close()
+            print 'coalesce=%-5s %8.3fs %8d receiver calls %8d merged' % (
+                coalesce, elapsed, sum(r.calls for r in receivers),
+                invoker.metrics()['merged'])
+
+    class Primes(object):
+        def count(self, n):
+            return sum(1 for k in xrange(2, n)
+                       if all(k % d for d in xrange(2, int(k ** 0.5) + 1)))
+
+    def processes(self, count=500):
+        Registry.register('primes', self.Primes)
+        commands = [RemoteCommand('primes', 'count', 2000 + n % 100)
+                    for n in xrange(count)]
+
+        started = time.time()
+        expected = [command.execute() for command in commands]
+        print '%-20s %8.3fs' % ('in process', time.time() - started)
+
+        invoker = ProcessInvoker(batch=64)
+        started = time.time()
+        for command in commands:
+            invoker.storeCommand(command)
+        assert list(invoker.operation()) == expected
+        print '%-20s %8.3fs (%d processes)' % (
+            'process pool', time.time() - started, multiprocessing.cpu_count())
+        invoker.close()
+
+    def timers(self, count=1000000):
+        wheel = TimerWheel(tick=0.001)
+        command = ConcreteCommand(self.Receiver())
+        started = time.time()
+        timers = [wheel.schedule(command, n % 3600) for n in xrange(count)]
+        elapsed = time.time() - started
+        per_timer = sys.getsizeof(timers[0]) + 8
+        print '%-20s %8.3fs %8d bytes/timer' % ('schedule', elapsed, per_timer)
+
+        started = time.time()
+        for timer in timers[::2]:
+            wheel.cancel(timer)
+        print '%-20s %8.3fs' % ('cancel half', time.time() - started)
+
+    def history(self, count=200000):
+        for name, options in [
+                ('history', dict()),
+                ('history, compressed', dict(compress=True)),
+                ('history, 1MB cap', dict(maxbytes=1 << 20))]:
+            document = list('x' * 1000)
+            history = History(**options)
+            edits = [self.Edit(document, n % 1000, chr(97 + n % 26))
+                     for n in xrange(count)]
+            started = time.time()
+            for edit in edits:
+                history.execute(edit)
+            elapsed = time.time() - started
+            per_entry = history.size() / float(len(history))
+            undo = min(timeit.repeat(history.undo, number=1000, repeat=3))
+            print '%-20s %8.3fs %8.0f bytes/entry %6.2fus/undo' % (
+                name, elapsed, per_entry, undo * 1000)
+
+    def main(self, count=2000):
+        for name, options in [
+                ('fsync per command', dict(group=1)),
+                ('group commit', dict(group=64, latency=0.002)),
+                ('group commit, 10ms', dict(group=256, latency=0.01)),
+                ('no fsync', dict(group=1, sync=False))]:
+            directory = tempfile.mkdtemp()
+            try:
+                log = CommandLog(directory, **options)
+                invoker = QueuedInvoker(workers=16, log=log)
+                started = time.time()
+                for n in xrange(count):
+                    invoker.storeCommand(ConcreteCommand(self.Receiver()))
+                invoker.operation()
+                elapsed = time.time() - started
+                invoker.close()
+                log.close()
+                print '%-20s %8.3fs %10.0f commands/s' % (name, elapsed,
+                                                          count / elapsed)
+            finally:
+                shutil.rmtree(directory)
 
 
 if __name__ == '__main__':
+    if '--benchmark' in sys.argv:
+        b = Benchmark()
+        b.main()
+        b.history()
+        b.coalesce()
+        b.timers()
+        b.processes()
+        sys.exit()
+
     # 1. The client creates a ConcreteCommand object and specifies its receiver.
     # 2. An Invoker object stores the ConcreteCommand object.
     i = Invoker()
@@ -97,3 +1000,19 @@ if __name__ == '__main__':
     # 4. The ConcreteCommand object invokes operations on its reciver to
     #    carryout the request.
     i.operation()
+
+    # Many commands can be queued and executed later on a pool of workers.
+    q = QueuedInvoker(workers=2, maxsize=4)
+    for n in xrange(8):
+        q.storeCommand(ConcreteCommand(Receiver()))
+    q.operation()
+
+    # Commands can also be scheduled to run later, or periodically.
+    w = TimerWheel(tick=0.01, executor=q)
+    w.schedule(ConcreteCommand(Receiver()), 0.05)
+    w.start()
+    time.sleep(0.1)
+    w.stop()
+    q.operation()
+    q.close()
+    print q.metrics()
@@ -0,0 +1,76 @@
+import mmap
+import os
+
+
+class MappedInput(object):
+    """
+    Read-only input backed by a memory mapped file object (or any other
+    buffer, such as a string or a bytearray) and a read offset. read() hands
+    out a small window of the remaining input as a buffer object, which
+    regular expressions can match without copying the mapping. consume()
+    takes a suffix of the last window, as produced by slicing it, and
+    advances the offset by what was cut off.
+    """
+    def __init__(self, source, window=64):
+        if hasattr(source, 'fileno'):
+            size = os.fstat(source.fileno()).st_size
+            # An empty file can't be mapped
+            source = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) \
+                if size else ''
+        self._data = source
+        self._size = len(source)
+        self._offset = 0
+        self._window = window
+        self._last = 0
+
+    def offset(self):
+        return self._offset
+
+    def read(self):
+        self._last = min(self._window, self._size - self._offset)
+        return buffer(self._data, self._offset, self._last)
+
+    def consume(self, rest):
+        self._offset += self._last - len(rest)
+        self._last = len(rest)
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+
+class MappedOutput(object):
+    """
+    Output written into a preallocated bytearray, which grows only if it
+    runs out of room, or straight into a writable file. Adding text to it
+    writes the text and returns the output itself, so interpreters that do
+    'context.abc(context.abc() + char)' append without building strings.
+    """
+    def __init__(self, target=None, size=0):
+        if target is None:
+            target = bytearray(size)
+        self._target = target
+        self._position = 0
+
+    def __add__(self, text):
+        self.write(text)
+        return self
+
+    def __len__(self):
+        return self._position
+
+    def __str__(self):
+        if isinstance(self._target, bytearray):
+            return str(self._target[:self._position])
+        return ''
+
+    def write(self, text):
+        end = self._position + len(text)
+        if isinstance(self._target, bytearray):
+            self._target[self._position:end] = text
+        else:
+            self._target.write(text)
+        self._position = end
+
+    def reset(self):
+        self._position = 0
@@ -1,4 +1,12 @@
 import re
+import string
+import sys
+import timeit
+from itertools import chain, islice
+from multiprocessing import Pool
+from StringIO import StringIO
+
+from mapped import MappedInput, MappedOutput
 
 
 class Context(object):
@@ -22,6 +30,36 @@ class Context(object):
             self._output = txt
 
 
+class MappedContext(Context):
+    """
+    Context over a memory mapped message, for input too large to hold in a
+    string. Slicing the input only moves a read offset and the decoded text
+    goes into a preallocated bytearray or a writable file (see mapped.py).
+    """
+    def __init__(self, source, output=None, size=0):
+        self._input = MappedInput(source)
+        self._output = MappedOutput(output, size)
+
+    def __str__(self):
+        return str(self._output)
+
+    def morse(self, txt=None):
+        if txt is None:
+            return self._input.read()
+        else:
+            self._input.consume(txt)
+
+    def abc(self, txt=None):
+        if txt is None:
+            return self._output
+        elif txt is not self._output:
+            self._output.reset()
+            self._output.write(txt)
+
+    def close(self):
+        self._input.close()
+
+
 class AbstractExpression(object):
     def interpret(self, context):
         # If end of message
@@ -93,11 +131,298 @@ class NonterminalExpression(AbstractExpression):
         return self._char.char()
 
 
-class Client(object):
-    def main(self):
-        message = '... --- ...'
-        context = Context(message)
+class SymbolTable(dict):
+    """
+    Code -> char table for whole symbols. Codes that run past the leaves of
+    the tree are resolved by the state machine. Those no longer than the
+    deepest code of the tree are remembered from then on; longer ones, which
+    can be arbitrarily long garbage, are resolved every time.
+    """
+    def __init__(self, machine):
+        super(SymbolTable, self).__init__(machine.table())
+        self._machine = machine
+        self._depth = max(len(code) for code in self)
+
+    def __missing__(self, code):
+        char = self._machine._chars[self._machine._feed(code, [])[0]]
+        if len(code) <= self._depth:
+            self[code] = char
+        return char
+
+
+class CompiledExpression(object):
+    """
+    Translates the abstract syntax tree into a state machine once, then
+    decodes in a single pass over the message. Every node becomes a state
+    with a dot and a dash transition; terminal nodes loop onto themselves,
+    just like TerminalExpression.left() and right() do.
+    """
+    # Line breaks in streamed input separate symbols like a blank does
+    newlines = string.maketrans('\r\n', '  ')
+
+    def __init__(self, root):
+        self._dot = []
+        self._dash = []
+        self._chars = []
+        self._codes = []
+
+        states = {id(root): 0}
+        self._add(root, '')
+        pending = [root]
+        # Breadth first, so the first code recorded for a char is the shortest
+        while pending:
+            following = []
+            for node in pending:
+                state = states[id(node)]
+                for child, symbol, table in ((node.left(), '.', self._dot),
+                                             (node.right(), '-', self._dash)):
+                    if id(child) not in states:
+                        states[id(child)] = len(self._chars)
+                        self._add(child, self._codes[state] + symbol)
+                        following.append(child)
+                    table[state] = states[id(child)]
+            pending = following
+
+        self._symbols = SymbolTable(self)
+
+    def _add(self, node, code):
+        self._dot.append(None)
+        self._dash.append(None)
+        self._chars.append(node.char())
+        self._codes.append(code)
 
+    def table(self):
+        """
+        Returns the code -> char table of every state in the machine.
+        """
+        return dict(zip(self._codes, self._chars))
+
+    def _feed(self, morse, output, state=0, started=False, blank=False):
+        """
+        Decodes one piece of a message into output and returns the machine
+        registers (state, started, blank) so the next piece can resume where
+        this one stopped. started is True once a symbol has begun but has not
+        been emitted yet; blank is True right after a separator, since a
+        second blank belongs to the same separator.
+        """
+        dot, dash, chars = self._dot, self._dash, self._chars
+        for symbol in morse:
+            if symbol == '.':
+                state = dot[state]
+                started = True
+                blank = False
+            elif symbol == '-':
+                state = dash[state]
+                started = True
+                blank = False
+            elif symbol == ' ':
+                # A double blank is consumed as a single separator
+                if blank:
+                    blank = False
+                    continue
+                output.append(chars[state])
+                state = 0
+                started = False
+                blank = True
+            else:
+                raise Exception('Syntax error')
+        return state, started, blank
+
+    def decode(self, morse):
+        output = []
+        state, started, blank = self._feed(morse, output)
+        # End of message
+        if started:
+            output.append(self._chars[state])
+        return ''.join(output)
+
+    def stream(self, chunks):
+        """
+        Decodes an iterable of chunks (e.g. a file object or a pipe) and
+        yields the text decoded so far after each chunk. Symbols may span
+        chunk boundaries; only the machine registers are kept in between.
+        Unlike decode(), line breaks are read as blanks, so files and pipes
+        with newline terminated lines can be streamed.
+        """
+        registers = (0, False, False)
+        for chunk in chunks:
+            output = []
+            registers = self._feed(chunk.translate(self.newlines), output,
+                                   *registers)
+            if output:
+                yield ''.join(output)
+        state, started, blank = registers
+        # End of message
+        if started:
+            yield self._chars[state]
+
+    def read(self, stream, size=65536):
+        """
+        Streams a file object in fixed size chunks, so memory stays bounded
+        even when the message is a single line.
+        """
+        return self.stream(iter(lambda: stream.read(size), ''))
+
+    def decode_symbols(self, morse):
+        """
+        Same result as decode(), but splits the message into symbols and
+        looks each one up in the symbol table, which keeps the per char work
+        inside str.split() and the lookup inside map().
+        """
+        symbols = morse.split(' ')
+        # A trailing blank closes the last symbol, it doesn't start a new one
+        if not symbols[-1]:
+            symbols.pop()
+        if '  ' not in morse:
+            return ''.join(map(self._symbols.__getitem__, symbols))
+
+        # A double blank leaves an empty symbol behind, which is skipped
+        # unless it follows another skipped one
+        output = []
+        blank = False
+        for code in symbols:
+            if blank and not code:
+                blank = False
+            else:
+                output.append(self._symbols[code])
+                blank = True
+        return ''.join(output)
+
+    def pool(self, processes=None):
+        """
+        Returns a process pool whose workers hold this machine, to be reused
+        across calls to decode_batch(). The caller closes it.
+        """
+        return Pool(processes, _initialize, (self,))
+
+    def decode_batch(self, messages, processes=None, chunksize=4096,
+                     pool=None):
+        """
+        Decodes a list of messages. With a pool (from pool()), or processes
+        set, the batch is split into chunks of chunksize messages and decoded
+        on a process pool. Without a pool, one is started for the call.
+        """
+        if pool is None and not processes or len(messages) <= chunksize:
+            return map(self.decode_symbols, messages)
+
+        owned = pool is None
+        if owned:
+            pool = self.pool(processes)
+        try:
+            chunks = [messages[i:i + chunksize]
+                      for i in xrange(0, len(messages), chunksize)]
+            return list(chain.from_iterable(pool.map(_decode_chunk, chunks)))
+        finally:
+            if owned:
+                pool.close()
+                pool.join()
+
+    def interpret(self, context):
+        # Takes the input piece by piece, so mapped contexts are never read
+        # as a whole
+        output = []
+        registers = (0, False, False)
+        morse = context.morse()
+        while len(morse) > 0:
+            registers = self._feed(morse, output, *registers)
+            context.morse('')
+            morse = context.morse()
+        state, started, blank = registers
+        # End of message
+        if started:
+            output.append(self._chars[state])
+        context.abc(context.abc() + ''.join(output))
+
+
+# Pool workers receive the machine once through the initializer and then
+# decode whole chunks of messages
+_machine = None
+
+
+def _initialize(machine):
+    global _machine
+    _machine = machine
+
+
+def _decode_chunk(messages):
+    return map(_machine.decode_symbols, messages)
+
+
+class CompiledEncoder(object):
+    """
+    Encodes text into Morse with a char -> code table taken from the same
+    state machine the decoder runs on, so both directions always agree.
+    Symbols are separated by a blank, or by a double blank when the next
+    char is the blank itself, since a single one would be read as part of
+    the previous separator. Output is written into a reusable bytearray
+    rather than built by concatenation, so an encoder instance must not be
+    shared between threads.
+    """
+    def __init__(self, root):
+        table = CompiledExpression(root).table()
+        self._codes = dict()
+        # Shortest code first, in case a char appears more than once
+        for code in sorted(table, key=len):
+            if len(table[code]) == 1:
+                self._codes.setdefault(table[code], code)
+        # The piece written for a char that follows another symbol
+        self._pieces = dict((char, ('  ' if not code else ' ') + code)
+                            for char, code in self._codes.items())
+        self._buffer = bytearray()
+
+    def _feed(self, text, buffer, started=False):
+        """
+        Writes the symbols of text into buffer. started tells whether a
+        symbol was already written, i.e. whether the first char of text
+        needs a separator in front of it.
+        """
+        if not text:
+            return started
+        try:
+            if not started:
+                buffer.extend(self._codes[text[0]])
+                text = islice(text, 1, None)
+            buffer.extend(''.join(map(self._pieces.__getitem__, text)))
+        except KeyError:
+            raise Exception('Syntax error')
+        return True
+
+    def _close(self, buffer, last):
+        # A trailing blank has no following symbol to terminate it
+        if last is not None and not self._codes[last]:
+            buffer.extend(' ')
+
+    def encode(self, text):
+        buffer = self._buffer
+        del buffer[:]
+        self._feed(text, buffer)
+        self._close(buffer, text[-1:] or None)
+        return str(buffer)
+
+    def encode_batch(self, texts):
+        return map(self.encode, texts)
+
+    def stream(self, chunks):
+        """
+        Encodes an iterable of text chunks and yields the Morse written for
+        each one. Only the last char seen is kept in between.
+        """
+        buffer = self._buffer
+        started, last = False, None
+        for chunk in chunks:
+            del buffer[:]
+            started = self._feed(chunk, buffer, started)
+            last = chunk[-1:] or last
+            if buffer:
+                yield str(buffer)
+        del buffer[:]
+        self._close(buffer, last)
+        if buffer:
+            yield str(buffer)
+
+
+class Client(object):
+    def tree(self):
         # Create chars
         a = TerminalExpression('a')
         b = TerminalExpression('b')
@@ -160,13 +485,66 @@ class Client(object):
         n2  = NonterminalExpression(char=t, dot=n5, dash=n6)
         n1  = NonterminalExpression(char=e, dot=n3, dash=n4)
         root = NonterminalExpression(char=blank, dot=n1, dash=n2)
+        return root
+
+    def main(self):
+        message = '... --- ...'
+        context = Context(message)
+        root = self.tree()
 
         while len(context.morse()) > 0:
             root.interpret(context)
 
         print '%s = %s' % (message, context.abc())
+        compiled = CompiledExpression(root)
+        print '%s = %s (compiled)' % (message, compiled.decode(message))
+        stream = StringIO(message)
+        print '%s = %s (streamed)' % (message, ''.join(compiled.read(stream, 4)))
+
+        text = 'hello world'
+        print '%s = %s' % (text, CompiledEncoder(root).encode(text))
+
+
+class Benchmark(object):
+    def main(self, count=20000):
+        root = Client().tree()
+        compiled = CompiledExpression(root)
+        words = ['... --- ...', '.... . .-.. .-.. ---', '.-- --- .-. .-.. -..',
+                 '- . .-.. . -- . - .-. -.--', '-.-. --.-  -.. .']
+        messages = [words[i % len(words)] for i in xrange(count)]
+
+        def interpret():
+            for message in messages:
+                context = Context(message)
+                while len(context.morse()) > 0:
+                    root.interpret(context)
+
+        pool = compiled.pool(4)
+        for name, run in [
+                ('interpret', interpret),
+                ('decode', lambda: map(compiled.decode, messages)),
+                ('decode_batch', lambda: compiled.decode_batch(messages)),
+                ('decode_batch (pool)',
+                 lambda: compiled.decode_batch(messages, pool=pool))]:
+            elapsed = min(timeit.repeat(run, number=1, repeat=3))
+            print '%-20s %8.3fs %10.0f msg/s' % (name, elapsed, count / elapsed)
+        pool.close()
+        pool.join()
+
+        encoder = CompiledEncoder(root)
+        texts = compiled.decode_batch(messages)
+        roundtrip = lambda: compiled.decode_batch(encoder.encode_batch(texts))
+        for name, run in [
+                ('encode_batch', lambda: encoder.encode_batch(texts)),
+                ('round trip', roundtrip)]:
+            elapsed = min(timeit.repeat(run, number=1, repeat=3))
+            print '%-20s %8.3fs %10.0f msg/s' % (name, elapsed, count / elapsed)
 
 
 if __name__ == '__main__':
-    c = Client()
-    c.main()
+    if '--benchmark' in sys.argv:
+        b = Benchmark()
+        b.main()
+    else:
+        c = Client()
+        c.main()
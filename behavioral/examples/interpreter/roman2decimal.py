@@ -1,4 +1,8 @@
 import re
+import sys
+import timeit
+
+from mapped import MappedInput
 
 
 class Context(object):
@@ -19,6 +23,25 @@ class Context(object):
             self._decimal = number
 
 
+class MappedContext(Context):
+    """
+    Context over a memory mapped numeral. Slicing the input only moves a
+    read offset (see mapped.py).
+    """
+    def __init__(self, source):
+        self._roman = MappedInput(source)
+        self._decimal = 0
+
+    def roman(self, number=None):
+        if number is None:
+            return self._roman.read()
+        else:
+            self._roman.consume(number)
+
+    def close(self):
+        self._roman.close()
+
+
 class AbstractExpression(object):
     def interpret(self, context):
         if len(context.roman()) == 0:
@@ -87,24 +110,195 @@ class BaseExpression(AbstractExpression):
     def multiplier(self): return 1
 
 
-class Client(object):
-    def main(self):
-        roman = 'MCMLXXXVII'
-        context = Context(roman)
+class CompiledExpression(object):
+    """
+    Reads the symbols and multiplier of every digit class once, then
+    converts in a single pass: a cursor walks the numeral and each symbol is
+    compared in place with str.startswith(), so nothing is matched with a
+    regex and nothing is sliced. Blank symbols mean the digit class has
+    none (e.g. there is no five thousand).
+    """
+    def __init__(self, tree):
+        self._classes = []
+        for expression in tree:
+            symbols = [(expression.nine(), 9), (expression.four(), 4),
+                       (expression.five(), 5)]
+            self._classes.append((
+                [(s, v * expression.multiplier()) for s, v in symbols
+                 if s.strip()],
+                expression.one(),
+                expression.multiplier()))
+        self._numerals = None
+        self._romans = None
+
+    def convert(self, roman, strict=False):
+        """
+        Converts a numeral the way the chain of expressions does, which
+        also accepts some malformed ones (e.g. 'IIII'). With strict set,
+        only canonical numerals are accepted: a digit class repeats its one
+        symbol at most three times, and not at all after its four or nine.
+        """
+        decimal = 0
+        i, n = 0, len(roman)
+        for symbols, one, multiplier in self._classes:
+            repeat = n
+            for symbol, value in symbols:
+                if roman.startswith(symbol, i):
+                    decimal += value
+                    i += len(symbol)
+                    if strict:
+                        repeat = 3 if value == 5 * multiplier else 0
+                    break
+            else:
+                if strict:
+                    repeat = 3
+            while repeat and roman.startswith(one, i):
+                decimal += multiplier
+                i += len(one)
+                repeat -= 1
+        if i < n:
+            raise Exception('Syntax error at position %d: %r' % (i, roman))
+        return decimal
+
+    def numerals(self):
+        """
+        Returns the table of every numeral from 0 to the largest one the
+        digit classes can spell without repeating a symbol more than three
+        times. It is built the first time it's needed.
+        """
+        if self._numerals is None:
+            numerals = {'': 0}
+            for symbols, one, multiplier in self._classes:
+                digits = dict((one * k, k * multiplier) for k in xrange(4))
+                values = dict((v, s) for s, v in symbols)
+                if 5 * multiplier in values:
+                    five = values[5 * multiplier]
+                    digits.update((five + one * k, (5 + k) * multiplier)
+                                  for k in xrange(4))
+                digits.update((s, v) for s, v in symbols)
+                numerals = dict((a + b, x + y)
+                                for a, x in numerals.iteritems()
+                                for b, y in digits.iteritems())
+            self._numerals = numerals
+        return self._numerals
+
+    def convert_batch(self, numerals):
+        """
+        Converts a list of canonical numerals with one table lookup each.
+        Anything outside the table, such as 'IIII', is rejected with the
+        position convert(strict=True) finds wrong.
+        """
+        table = self.numerals()
+        return [table[roman] if roman in table
+                else self.convert(roman, strict=True) for roman in numerals]
 
+    def romans(self):
+        """
+        Returns the reverse of numerals() as a list indexed by value, also
+        built the first time it's needed.
+        """
+        if self._romans is None:
+            romans = [None] * len(self.numerals())
+            for roman, decimal in self.numerals().iteritems():
+                romans[decimal] = roman
+            self._romans = romans
+        return self._romans
+
+    def format(self, decimal):
+        romans = self.romans()
+        if not 0 < decimal < len(romans):
+            raise Exception('Out of range: %r' % decimal)
+        return romans[decimal]
+
+    def format_batch(self, decimals):
+        """
+        Formats a list of integers with one table lookup each. The range is
+        checked for the whole batch up front.
+        """
+        romans = self.romans()
+        if decimals and not 0 < min(decimals) <= max(decimals) < len(romans):
+            raise Exception('Out of range: %r..%r' % (min(decimals),
+                                                       max(decimals)))
+        return map(romans.__getitem__, decimals)
+
+    def interpret(self, context):
+        # Mapped contexts hand out the numeral piece by piece
+        pieces = []
+        roman = context.roman()
+        while len(roman) > 0:
+            pieces.append(str(roman))
+            context.roman('')
+            roman = context.roman()
+        context.decimal(context.decimal() + self.convert(''.join(pieces)))
+
+
+class Client(object):
+    def tree(self):
         # Build the Abstract Syntax Tree
         tree = list()
         tree.append(ThousandExpression())
         tree.append(HundredExpression())
         tree.append(TenExpression())
         tree.append(BaseExpression())
+        return tree
+
+    def main(self):
+        roman = 'MCMLXXXVII'
+        context = Context(roman)
+        tree = self.tree()
 
         for i in tree:
             i.interpret(context)
 
         print '%s = %s' % (roman, context.decimal())
+        compiled = CompiledExpression(tree)
+        print '%s = %s (compiled)' % (roman, compiled.convert(roman))
+        numerals = ['MMXXIV', 'XLII', 'MMMCMXCIX']
+        print '%s = %s (batch)' % (numerals, compiled.convert_batch(numerals))
+        decimals = [1987, 2024, 42]
+        print '%s = %s' % (decimals, compiled.format_batch(decimals))
+
+
+class Benchmark(object):
+    def __init__(self):
+        self.tree = Client().tree()
+
+    def naive(self, decimal):
+        # Formats digit by digit, largest class first
+        roman = ''
+        for expression in self.tree:
+            digit = decimal // expression.multiplier() % 10
+            if expression.multiplier() == 1000:
+                roman += expression.one() * (decimal // 1000)
+            elif digit == 9:
+                roman += expression.nine()
+            elif digit == 4:
+                roman += expression.four()
+            else:
+                roman += expression.five() * (digit // 5)
+                roman += expression.one() * (digit % 5)
+        return roman
+
+    def main(self, count=200000):
+        compiled = CompiledExpression(self.tree)
+        decimals = [i % 3999 + 1 for i in xrange(count)]
+        numerals = compiled.format_batch(decimals)
+        assert map(self.naive, decimals[:3999]) == numerals[:3999]
+
+        for name, run in [
+                ('naive format', lambda: map(self.naive, decimals)),
+                ('format', lambda: map(compiled.format, decimals)),
+                ('format_batch', lambda: compiled.format_batch(decimals)),
+                ('convert', lambda: map(compiled.convert, numerals)),
+                ('convert_batch', lambda: compiled.convert_batch(numerals))]:
+            elapsed = min(timeit.repeat(run, number=1, repeat=3))
+            print '%-15s %8.3fs %12.0f/s' % (name, elapsed, count / elapsed)
 
 
 if __name__ == '__main__':
-    c = Client()
-    c.main()
+    if '--benchmark' in sys.argv:
+        b = Benchmark()
+        b.main()
+    else:
+        c = Client()
+        c.main()
@@ -18,6 +18,15 @@ works best when:
        the translator can be implemented by the Interpreter pattern, such
        pattern is still applicable.
 """
+import __future__
+import operator
+import random
+import re
+import sys
+import timeit
+from collections import OrderedDict
+
+
 class AbstractExpression(object):
     """
     Declares an abstract Interpret operation that is common to all nodes in
@@ -29,15 +38,64 @@ class AbstractExpression(object):
     def interpret(self, context):
         raise NotImplementedError
 
+    def fold(self):
+        """
+        Returns an equivalent tree where every subtree that doesn't depend on
+        the context has been replaced by its value.
+        """
+        raise NotImplementedError
+
+    def source(self):
+        """
+        Returns the Python source of the expression, reading variables from
+        a record named r.
+        """
+        raise NotImplementedError
+
+    def compile(self):
+        """
+        Translates the tree into a Python code object once and returns a
+        function of a record, so evaluating it no longer walks the tree.
+        """
+        code = compile('lambda r: ' + self.source(), '<rule>', 'eval',
+                       __future__.division.compiler_flag)
+        return eval(code, {})
+
 
 class TerminalExpression(AbstractExpression):
     """
     1. Implements an Interpret operation associated with terminal symbols in
        the grammar.
     2. An instance is required for every terminal symbol in a sentence.
+
+    A terminal is either a constant (a number or a boolean) or the name of a
+    variable looked up in the context.
     """
+    def __init__(self, expression=None, name=None):
+        super(TerminalExpression, self).__init__(expression)
+        self._name = name
+
+    def __repr__(self):
+        return self._name if self._name is not None else repr(self._expression)
+
+    def constant(self):
+        return self._name is None
+
+    def value(self):
+        return self._expression
+
     def interpret(self, context):
-        pass
+        if self._name is None:
+            return self._expression
+        return context.lookup(self._name)
+
+    def fold(self):
+        return self
+
+    def source(self):
+        if self._name is None:
+            return repr(self._expression)
+        return 'r[%r]' % self._name
 
 
 class NonterminalExpression(AbstractExpression):
@@ -48,16 +106,224 @@ class NonterminalExpression(AbstractExpression):
     3. Implements an Interpret operation for nonterminal symbols in the
        grammar. Interpret typically calls itself recursively on the variables
        representing the symbols it maintains.
+
+    The expression is the operator; operands are the subtrees it applies to.
+    'and' and 'or' short-circuit like their Python counterparts.
     """
+    binary = {
+        '+': operator.add, '-': operator.sub, '*': operator.mul,
+        '/': operator.truediv, '%': operator.mod,
+        '<': operator.lt, '<=': operator.le, '>': operator.gt,
+        '>=': operator.ge, '==': operator.eq, '!=': operator.ne,
+    }
+    unary = {'-': operator.neg, 'not': operator.not_}
+
+    def __init__(self, expression, *operands):
+        super(NonterminalExpression, self).__init__(expression)
+        self._operands = operands
+
+    def __repr__(self):
+        return '(%s %s)' % (self._expression,
+                            ' '.join(map(repr, self._operands)))
+
+    def constant(self):
+        return False
+
     def interpret(self, context):
-        pass
+        if self._expression == 'and':
+            left, right = self._operands
+            return left.interpret(context) and right.interpret(context)
+        if self._expression == 'or':
+            left, right = self._operands
+            return left.interpret(context) or right.interpret(context)
+        if len(self._operands) == 1:
+            return self.unary[self._expression](
+                self._operands[0].interpret(context))
+        left, right = self._operands
+        return self.binary[self._expression](left.interpret(context),
+                                             right.interpret(context))
+
+    def fold(self):
+        operands = [o.fold() for o in self._operands]
+        if self._expression in ('and', 'or') and operands[0].constant():
+            # Short-circuit like interpret() would, so a right side that
+            # never runs is never evaluated either
+            left, right = operands
+            if bool(left.value()) == (self._expression == 'or'):
+                return left
+            return right
+        node = NonterminalExpression(self._expression, *operands)
+        if all(o.constant() for o in operands):
+            try:
+                return TerminalExpression(node.interpret(Context()))
+            except Exception:
+                # e.g. a division by zero: left to fail if it's ever reached
+                pass
+        return node
+
+    def source(self):
+        if len(self._operands) == 1:
+            return '(%s %s)' % (self._expression, self._operands[0].source())
+        left, right = self._operands
+        return '(%s %s %s)' % (left.source(), self._expression,
+                               right.source())
 
 
 class Context(object):
     """
     Contains information that's global to the interpreter.
+
+    Here, the record whose fields the variables refer to.
+    """
+    def __init__(self, record=None):
+        self._record = record if record is not None else dict()
+
+    def record(self, record=None):
+        if record is None:
+            return self._record
+        else:
+            self._record = record
+
+    def lookup(self, name):
+        return self._record[name]
+
+
+class Parser(object):
     """
-    pass
+    Builds abstract syntax trees from rule sources, by recursive descent over
+    the grammar below (lowest precedence first):
+
+        or         := and ('or' and)*
+        and        := not ('and' not)*
+        not        := 'not' not | comparison
+        comparison := sum (('<' | '<=' | '>' | '>=' | '==' | '!=') sum)?
+        sum        := term (('+' | '-') term)*
+        term       := unary (('*' | '/' | '%') unary)*
+        unary      := '-' unary | atom
+        atom       := number | 'true' | 'false' | name | '(' or ')'
+
+    Parsed and folded trees are kept in a least recently used cache keyed by
+    source, so a rule seen before isn't parsed again.
+    """
+    token = re.compile(r'''\s*(?:
+        (?P<number>\d+\.\d*|\.\d+|\d+)
+        |(?P<name>[A-Za-z_]\w*)
+        |(?P<op><=|>=|==|!=|[-+*/%<>()])
+        )''', re.VERBOSE)
+    keywords = {'true': True, 'false': False}
+
+    def __init__(self, maxsize=1024):
+        self._maxsize = maxsize
+        self._cache = OrderedDict()
+
+    def parse(self, source):
+        if source in self._cache:
+            tree = self._cache.pop(source)
+        else:
+            self._tokens = self._tokenize(source)
+            self._position = 0
+            tree = self._or()
+            if self._peek() is not None:
+                self._error()
+            tree = tree.fold()
+            if self._cache and len(self._cache) >= self._maxsize:
+                self._cache.popitem(last=False)
+        if self._maxsize > 0:
+            self._cache[source] = tree
+        return tree
+
+    def _tokenize(self, source):
+        tokens = []
+        i, n = 0, len(source.rstrip())
+        while i < n:
+            match = self.token.match(source, i)
+            if match is None:
+                i = n - len(source[i:n].lstrip())
+                raise Exception('Syntax error at position %d: %r' % (i, source))
+            kind = match.lastgroup
+            text = match.group(kind)
+            if kind == 'number':
+                tokens.append(('number', float(text) if '.' in text
+                               else int(text), match.start(kind)))
+            elif kind == 'name' and text in ('and', 'or', 'not'):
+                tokens.append(('op', text, match.start(kind)))
+            else:
+                tokens.append((kind, text, match.start(kind)))
+            i = match.end()
+        return tokens
+
+    def _peek(self):
+        if self._position < len(self._tokens):
+            return self._tokens[self._position][1]
+        return None
+
+    def _next(self):
+        token = self._tokens[self._position]
+        self._position += 1
+        return token
+
+    def _error(self):
+        if self._position < len(self._tokens):
+            raise Exception('Syntax error at position %d' %
+                            self._tokens[self._position][2])
+        raise Exception('Syntax error: unexpected end of rule')
+
+    def _binary(self, operand, operators):
+        node = operand()
+        while self._peek() in operators:
+            node = NonterminalExpression(self._next()[1], node, operand())
+        return node
+
+    def _or(self):
+        return self._binary(self._and, ('or',))
+
+    def _and(self):
+        return self._binary(self._not, ('and',))
+
+    def _not(self):
+        if self._peek() == 'not':
+            self._next()
+            return NonterminalExpression('not', self._not())
+        return self._comparison()
+
+    def _comparison(self):
+        node = self._sum()
+        if self._peek() in ('<', '<=', '>', '>=', '==', '!='):
+            node = NonterminalExpression(self._next()[1], node, self._sum())
+        return node
+
+    def _sum(self):
+        return self._binary(self._term, ('+', '-'))
+
+    def _term(self):
+        return self._binary(self._unary, ('*', '/', '%'))
+
+    def _unary(self):
+        if self._peek() == '-':
+            self._next()
+            return NonterminalExpression('-', self._unary())
+        return self._atom()
+
+    def _atom(self):
+        if self._position >= len(self._tokens):
+            self._error()
+        kind, text, position = self._tokens[self._position]
+        if kind == 'number':
+            self._next()
+            return TerminalExpression(text)
+        if kind == 'name':
+            self._next()
+            if text in self.keywords:
+                return TerminalExpression(self.keywords[text])
+            return TerminalExpression(name=text)
+        if text == '(':
+            self._next()
+            node = self._or()
+            if self._peek() != ')':
+                self._error()
+            self._next()
+            return node
+        self._error()
 
 
 class Client(object):
@@ -69,9 +335,41 @@ class Client(object):
     2. Invokes the Interpret operation.
     """
     def main(self):
-        pass
+        parser = Parser()
+        rule = 'price * (1 + 20 / 100) > limit and not blocked'
+        tree = parser.parse(rule)
+        record = {'price': 90, 'limit': 100, 'blocked': False}
+
+        print '%s = %s' % (tree, tree.interpret(Context(record)))
+        print '%s = %s (compiled)' % (tree.source(), tree.compile()(record))
+
+
+class Benchmark(object):
+    def main(self, count=200000):
+        rule = 'price * (1 + 20 / 100) > limit and not blocked or vip'
+        tree = Parser().parse(rule)
+        compiled = tree.compile()
+        records = [{'price': random.randint(0, 200), 'limit': 100,
+                    'blocked': random.random() < 0.1, 'vip': False}
+                   for i in xrange(count)]
+
+        def interpret():
+            context = Context()
+            for record in records:
+                context.record(record)
+                tree.interpret(context)
+
+        for name, run in [('interpret', interpret),
+                          ('compiled', lambda: map(compiled, records))]:
+            elapsed = min(timeit.repeat(run, number=1, repeat=3))
+            print '%-10s %8.3fs %12.0f records/s' % (name, elapsed,
+                                                      count / elapsed)
 
 
 if __name__ == '__main__':
-    c = Client()
-    c.main()
+    if '--benchmark' in sys.argv:
+        b = Benchmark()
+        b.main()
+    else:
+        c = Client()
+        c.main()
@@ -8,6 +8,21 @@ Use the iterator pattern:
     3. to provide a uniform interface for traversing different aggregate
        structures.
 """
+import array
+import mmap
+import multiprocessing
+import operator
+import os
+import Queue
+import struct
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from itertools import chain, ifilter, imap, islice
+
+
 class Iterator(object):
     """
     Defines an interface for accessing and traversing elements.
@@ -24,55 +39,541 @@ class Iterator(object):
     def currentItem(self):
         raise NotImplementedError
 
+    def close(self):
+        """
+        Releases whatever the iterator holds while traversing; by default
+        nothing.
+        """
+        pass
+
 
 class ConcreteIterator(Iterator):
     """
     1. Implements the Iterator interface.
     2. Keeps track of the current position in the traversal of the aggregate.
+
+    Besides the four calls per element of the Iterator interface, it can be
+    used as a Python iterable, and next_batch(n) returns the next n elements
+    at once as a contiguous slice. All three move the same position. An
+    iterator may be limited to the range of elements from start to stop.
     """
-    def __init__(self, obj):
+    def __init__(self, obj, start=0, stop=None):
         self.aggregate = obj
+        self._start = start
+        self._stop = stop
+        self._current = start
+
+    def _end(self):
+        count = self.aggregate.count()
+        return count if self._stop is None else min(self._stop, count)
 
     def first(self):
-        pass
+        self._current = self._start
+
+    def seek(self, index):
+        # Seeking to the end of the range is allowed, and leaves it done
+        if not self._start <= index <= self._end():
+            raise IndexError('Iterator out of bounds')
+        self._current = index
 
     def next(self):
-        pass
+        self._current += 1
 
     def isDone(self):
-        pass
+        return self._current >= self._end()
 
     def currentItem(self):
-        pass
+        if self.isDone():
+            raise IndexError('Iterator out of bounds')
+        return self.aggregate.item(self._current)
+
+    def __iter__(self):
+        # Iterator.next() advances without returning an item, so iteration
+        # goes through a generator rather than the iterator itself
+        items = self.aggregate.items()
+        end = self._end()
+        while self._current < end:
+            self._current += 1
+            yield items[self._current - 1]
+
+    def next_batch(self, n):
+        """
+        Returns up to n elements from the current position and moves past
+        them. An empty batch means the traversal is done.
+        """
+        start = self._current
+        self._current = max(start, min(start + n, self._end()))
+        return self.aggregate.items()[start:self._current]
 
 
 class Aggregate(object):
     """
     Defines an interface for creating an Iterator object.
+
+    An aggregate can also be split into disjoint ranges, each traversed by
+    its own iterator, and reduced over them in parallel.
     """
-    def createIterator(self):
+    def count(self):
+        raise NotImplementedError
+
+    def createIterator(self, start=0, stop=None):
         raise NotImplementedError
 
+    def pipeline(self):
+        return Pipeline(self.createIterator())
+
+    def partition(self, n):
+        """
+        Returns n iterators over disjoint ranges of about the same size that
+        together cover the whole aggregate.
+        """
+        count = self.count()
+        bounds = [count * k // n for k in xrange(n + 1)]
+        return [self.createIterator(start, stop)
+                for start, stop in zip(bounds, bounds[1:])]
+
+    def reduce(self, reducer, combine, partitions=None, processes=None):
+        """
+        Calls reducer with an iterator over each partition, on a pool of
+        processes, and folds the partial results together with combine.
+        The pool is forked after the aggregate and reducer are published,
+        so neither is pickled; only the range bounds and the partial
+        results travel between processes.
+        """
+        global _reduction
+        processes = processes or multiprocessing.cpu_count()
+        iterators = self.partition(partitions or processes)
+        _reduction = (self, reducer)
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_reduce_partition, [(i._start, i._stop)
+                                                   for i in iterators])
+        finally:
+            pool.close()
+            pool.join()
+            _reduction = None
+        return reduce(combine, results)
+
 
 class ConcreteAggregate(Aggregate):
     """
     Implements the Iterator creation interface to return an instance of the
     proper ConcreteIterator.
+
+    Elements are kept in a list, or in an array.array when a typecode is
+    given, which stores numbers unboxed.
     """
-    def createIterator(self):
-        return ConcreteIterator(self)
+    def __init__(self, items=(), typecode=None):
+        if typecode is None:
+            self._items = list(items)
+        else:
+            self._items = array.array(typecode, items)
+
+    def count(self):
+        return len(self._items)
+
+    def item(self, index):
+        return self._items[index]
+
+    def items(self):
+        return self._items
+
+    def createIterator(self, start=0, stop=None):
+        return ConcreteIterator(self, start, stop)
+
+
+class MappedIterator(ConcreteIterator):
+    """
+    Traverses a MappedAggregate. Records are buffer objects over the shared
+    mapping, so nothing is copied until they're unpacked.
+    """
+    def __iter__(self):
+        end = self._end()
+        while self._current < end:
+            self._current += 1
+            yield self.aggregate.item(self._current - 1)
+
+    def next_batch(self, n):
+        """
+        Returns a list of up to n record buffers from the current position.
+        """
+        start = self._current
+        self._current = max(start, min(start + n, self._end()))
+        return self.aggregate.records(self.aggregate.slice(start,
+                                                           self._current))
+
+
+class MappedAggregate(Aggregate):
+    """
+    An aggregate of fixed-width binary records laid out as described by a
+    struct format, memory mapped from a file object (or read from any other
+    buffer). Every iterator has its own position over the same mapping, so
+    independent traversals don't copy anything.
+    """
+    def __init__(self, source, layout):
+        self._struct = struct.Struct(layout)
+        if hasattr(source, 'fileno'):
+            # An empty file can't be mapped
+            source = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) \
+                if os.fstat(source.fileno()).st_size else ''
+        self._data = source
+        self._count = len(source) // self._struct.size
+
+    def count(self):
+        return self._count
+
+    def item(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError('Record out of bounds')
+        size = self._struct.size
+        return buffer(self._data, index * size, size)
+
+    def slice(self, start, stop):
+        size = self._struct.size
+        return buffer(self._data, start * size, (stop - start) * size)
+
+    def records(self, data):
+        """
+        Splits a buffer of consecutive records, such as a slice(), into
+        record buffers, still without copying.
+        """
+        size = self._struct.size
+        return [buffer(data, offset, size)
+                for offset in xrange(0, len(data), size)]
+
+    def unpack(self, record, index=0):
+        """
+        Unpacks a record, or the index-th record of a slice, into a tuple.
+        """
+        return self._struct.unpack_from(record, index * self._struct.size)
+
+    def createIterator(self, start=0, stop=None):
+        return MappedIterator(self, start, stop)
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+
+class PrefetchIterator(Iterator):
+    """
+    Wraps the iterator of a slow aggregate (e.g. one reading disk pages or
+    the output of a subprocess) and keeps up to window batches of batch
+    elements loading on a background thread, so fetching the next elements
+    overlaps with processing the current ones. Batches come out of
+    next_batch() in order; __iter__ and the Iterator interface read them
+    element by element. An error in the wrapped iterator is raised when the
+    batch it failed on is reached.
+    """
+    def __init__(self, iterator, batch=1024, window=4):
+        self._iterator = iterator
+        self._size = batch
+        self._window = window
+        self._thread = None
+        self.first()
+
+    def _start(self):
+        self._batches = Queue.Queue(self._window)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._fetch,
+                                        args=(self._batches, self._stopped))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fetch(self, batches, stopped):
+        while not stopped.is_set():
+            try:
+                batch = self._iterator.next_batch(self._size)
+            except Exception as e:
+                batch = e
+            while not stopped.is_set():
+                try:
+                    batches.put(batch, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+            if isinstance(batch, Exception) or not len(batch):
+                return
+
+    def close(self):
+        """
+        Stops the fetch thread. Batches not read yet are dropped, so the
+        traversal is done until first() starts it over.
+        """
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+            self._done = True
+
+    def next_batch(self, n=None):
+        """
+        Returns the next prefetched batch; an empty batch means the
+        traversal is done. n is ignored, batches have the size given to
+        the constructor.
+        """
+        if self._done:
+            return self._batch[:0]
+        if self._thread is None:
+            self._start()
+        batch = self._batches.get()
+        if isinstance(batch, Exception):
+            self._done = True
+            raise batch
+        if not len(batch):
+            self._done = True
+        return batch
+
+    def __iter__(self):
+        # Stopping early, e.g. when a loop breaks, closes the iterator
+        try:
+            while not self.isDone():
+                batch = self._batch
+                while self._index < len(batch):
+                    self._index += 1
+                    yield batch[self._index - 1]
+        finally:
+            self.close()
+
+    def first(self):
+        self.close()
+        self._iterator.first()
+        self._batch = []
+        self._index = 0
+        self._done = False
+
+    def next(self):
+        self._index += 1
+
+    def isDone(self):
+        if self._index >= len(self._batch) and not self._done:
+            self._batch = self.next_batch()
+            self._index = 0
+        return self._index >= len(self._batch)
+
+    def currentItem(self):
+        if self.isDone():
+            raise IndexError('Iterator out of bounds')
+        return self._batch[self._index]
+
+
+class Pipeline(object):
+    """
+    A lazy chain of map, filter, take and chunk stages over an iterator.
+    Nothing runs until the pipeline is iterated. Adjacent map and filter
+    stages are then fused: they're compiled into a single list
+    comprehension applied to each batch read from the iterator, so there's
+    one pass and one list per batch instead of one per stage. take stops
+    reading once the batch that fills it is done. Each stage returns a new
+    pipeline, so a partial one can be reused.
+    """
+    def __init__(self, iterator, stages=(), batch=4096):
+        self._iterator = iterator
+        self._stages = tuple(stages)
+        self._batch = batch
+
+    def _extend(self, kind, argument):
+        return Pipeline(self._iterator, self._stages + ((kind, argument),),
+                        self._batch)
+
+    def map(self, function):
+        return self._extend('map', function)
+
+    def filter(self, predicate):
+        return self._extend('filter', predicate)
+
+    def take(self, n):
+        return self._extend('take', n)
+
+    def chunk(self, n):
+        """
+        Groups the elements into lists of n (the last one may be shorter).
+        """
+        return self._extend('chunk', n)
+
+    def _batches(self):
+        # The iterator is closed once the pipeline stops reading from it,
+        # whether it ran out or a take was filled
+        self._iterator.first()
+        try:
+            batch = self._iterator.next_batch(self._batch)
+            while len(batch):
+                yield batch
+                batch = self._iterator.next_batch(self._batch)
+        finally:
+            self._iterator.close()
+
+    def __iter__(self):
+        batches = self._batches()
+        fused = []
+        for kind, argument in self._stages:
+            if kind not in ('map', 'filter'):
+                # Everything after the first take or chunk works per element
+                break
+            fused.append((kind, argument))
+        if fused:
+            batches = imap(self._fuse(fused), batches)
+        items = chain.from_iterable(batches)
+
+        for kind, argument in self._stages[len(fused):]:
+            if kind == 'map':
+                items = imap(argument, items)
+            elif kind == 'filter':
+                items = ifilter(argument, items)
+            elif kind == 'take':
+                items = islice(items, argument)
+            elif kind == 'chunk':
+                items = self._chunk(items, argument)
+        return iter(items)
+
+    def _fuse(self, stages):
+        """
+        Compiles map and filter stages into one function of a batch, e.g.
+        map f0, filter f1, map f2 becomes
+        [f2(v1) for v0 in batch for v1 in [f0(v0)] if f1(v1)].
+        """
+        current = 'v0'
+        clauses = ['for v0 in batch']
+        for i, (kind, function) in enumerate(stages):
+            if kind == 'map':
+                current = 'f%d(%s)' % (i, current)
+                continue
+            if current[0] != 'v':
+                # Bind the mapped value so it's only computed once
+                clauses.append('for v%d in [%s]' % (i + 1, current))
+                current = 'v%d' % (i + 1)
+            clauses.append('if f%d(%s)' % (i, current))
+        source = 'lambda batch: [%s %s]' % (current, ' '.join(clauses))
+        functions = dict(('f%d' % i, function)
+                         for i, (kind, function) in enumerate(stages))
+        return eval(source, functions)
+
+    def _chunk(self, items, n):
+        while True:
+            chunk = list(islice(items, n))
+            if not chunk:
+                return
+            yield chunk
+
+
+# The aggregate and reducer of the running Aggregate.reduce(), inherited by
+# its pool processes
+_reduction = None
+
+
+def _reduce_partition(bounds):
+    aggregate, reducer = _reduction
+    return reducer(aggregate.createIterator(*bounds))
 
 
 class Client(object):
     def main(self):
-        obj = ConcreteAggregate()
+        obj = ConcreteAggregate(range(10))
         i = obj.createIterator()
         i.first()
-        i.next()
-        i.currentItem()
-        i.isDone()
+        while not i.isDone():
+            print i.currentItem(),
+            i.next()
+        print
+
+        i.first()
+        print list(i)
+
+        i.first()
+        batch = i.next_batch(4)
+        while batch:
+            print batch,
+            batch = i.next_batch(4)
+        print
+
+        records = tempfile.TemporaryFile()
+        for n in xrange(10):
+            records.write(struct.pack('<id', n, n / 2.0))
+        records.flush()
+        obj = MappedAggregate(records, '<id')
+        i, j = obj.createIterator(), obj.createIterator()
+        j.seek(8)
+        print [obj.unpack(r) for r in i], obj.unpack(j.currentItem())
+        print list(obj.pipeline().map(obj.unpack).filter(lambda r: r[0] % 2)
+                   .take(3))
+        obj.close()
+
+        obj = ConcreteAggregate(xrange(1000), typecode='l')
+        print [list(i)[:3] for i in obj.partition(4)]
+        print obj.reduce(sum, operator.add, partitions=4)
+
+        squares = obj.pipeline().map(lambda x: x * x).filter(lambda x: x % 3)
+        print list(squares.take(10).chunk(4))
+
+
+class Benchmark(object):
+    class SlowIterator(ConcreteIterator):
+        # Stands in for an I/O bound source: each batch takes a while to read
+        def next_batch(self, n):
+            time.sleep(0.01)
+            return super(Benchmark.SlowIterator, self).next_batch(n)
+
+    def prefetch(self, count=100000, batch=1000):
+        obj = ConcreteAggregate(xrange(count), typecode='l')
+
+        def consume(iterator):
+            total = 0
+            chunk = iterator.next_batch(batch)
+            while len(chunk):
+                # Stands in for the consumer's own work on the batch
+                time.sleep(0.01)
+                total += sum(chunk)
+                chunk = iterator.next_batch(batch)
+            return total
+
+        for name, iterator in [
+                ('blocking', lambda: self.SlowIterator(obj)),
+                ('prefetch', lambda: PrefetchIterator(self.SlowIterator(obj),
+                                                      batch, window=4))]:
+            elapsed = min(timeit.repeat(lambda: consume(iterator()), number=1,
+                                        repeat=3))
+            print '%-30s %8.3fs' % (name, elapsed)
+
+    def main(self, count=1000000):
+        obj = ConcreteAggregate(xrange(count), typecode='l')
+
+        def protocol():
+            i = obj.createIterator()
+            i.first()
+            total = 0
+            while not i.isDone():
+                total += i.currentItem()
+                i.next()
+            return total
+
+        def native():
+            return sum(obj.createIterator())
+
+        def batched(i=None, size=4096):
+            i = i or obj.createIterator()
+            total = 0
+            batch = i.next_batch(size)
+            while batch:
+                total += sum(batch)
+                batch = i.next_batch(size)
+            return total
+
+        def partitioned():
+            return obj.reduce(batched, operator.add)
+
+        for name, run in [('first/next/isDone/currentItem', protocol),
+                          ('__iter__', native), ('next_batch', batched),
+                          ('reduce', partitioned)]:
+            elapsed = min(timeit.repeat(run, number=1, repeat=3))
+            print '%-30s %8.3fs %8.1fns/element' % (name, elapsed,
+                                                    elapsed / count * 1e9)
 
 
 if __name__ == '__main__':
-    c = Client()
-    c.main()
+    if '--benchmark' in sys.argv:
+        b = Benchmark()
+        b.main()
+        b.prefetch()
+    else:
+        c = Client()
+        c.main()
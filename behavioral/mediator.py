@@ -10,19 +10,303 @@ Use the pattern when:
     3. a behavior that's distributed between several classes should be
        customizable without a lot of subclassing.
 """
+import Queue
+import sys
+import threading
+import time
+import timeit
+
+
 class Mediator(object):
     """
     Defines an interface for communicating with Colleague objects.
     """
-    pass
+    def subscribe(self, colleague, topic, kind=None):
+        raise NotImplementedError
+
+    def unsubscribe(self, colleague, topic, kind=None):
+        raise NotImplementedError
+
+    def send(self, sender, topic, message):
+        raise NotImplementedError
+
+
+class TopicNode(object):
+    """
+    A node of the trie of wildcard subscriptions, one level per topic
+    segment. Subscribers are keyed by message kind, then by colleague id.
+    """
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children = dict()
+        self.subscribers = dict()
 
 
 class ConcreteMediator(Mediator):
     """
     1. Implements cooperative behavior by coordinating Colleague objects.
     2. Knows and maintains its colleagues.
+
+    Routes messages by topic, so a send only touches the colleagues that
+    subscribed to it. Topics are dot separated ('orders.eu.created'). A
+    subscription may be limited to one kind (class) of message, and its
+    topic may use wildcards: '*' stands for exactly one segment and '#' for
+    any number of them. Exact topics are found through a dict and wildcard
+    ones through a trie of segments, so subscribing, unsubscribing and
+    looking up a topic cost O(segments), not O(colleagues).
     """
-    pass
+    def __init__(self):
+        self._topics = dict()
+        self._wildcards = TopicNode()
+        self._patterns = 0
+
+    def _subscribers(self, segments, create=False):
+        # The kind -> colleagues table of a wildcard topic
+        node = self._wildcards
+        for segment in segments:
+            if segment not in node.children:
+                if not create:
+                    return None
+                node.children[segment] = TopicNode()
+            node = node.children[segment]
+        return node.subscribers
+
+    def subscribe(self, colleague, topic, kind=None):
+        segments = topic.split('.')
+        if '*' not in segments and '#' not in segments:
+            subscribers = self._topics.setdefault(topic, dict())
+            subscribers.setdefault(kind, dict())[id(colleague)] = colleague
+            return
+        colleagues = self._subscribers(segments, True).setdefault(kind, dict())
+        if id(colleague) not in colleagues:
+            self._patterns += 1
+        colleagues[id(colleague)] = colleague
+
+    def unsubscribe(self, colleague, topic, kind=None):
+        segments = topic.split('.')
+        if '*' not in segments and '#' not in segments:
+            subscribers = self._topics.get(topic)
+        else:
+            subscribers = self._subscribers(segments)
+        if subscribers is None or kind not in subscribers:
+            return
+        if subscribers[kind].pop(id(colleague), None) is not None and \
+                topic not in self._topics:
+            self._patterns -= 1
+        if not subscribers[kind]:
+            del subscribers[kind]
+        if not subscribers and topic in self._topics:
+            del self._topics[topic]
+
+    def _match(self, node, segments, i, found):
+        # Collects the subscribers of every pattern matching segments[i:]
+        if i == len(segments):
+            found.append(node.subscribers)
+        else:
+            child = node.children.get(segments[i])
+            if child is not None:
+                self._match(child, segments, i + 1, found)
+            child = node.children.get('*')
+            if child is not None:
+                self._match(child, segments, i + 1, found)
+        child = node.children.get('#')
+        if child is not None:
+            # '#' takes zero or more segments
+            for j in xrange(i, len(segments) + 1):
+                self._match(child, segments, j, found)
+
+    def recipients(self, topic, message):
+        """
+        Returns the colleagues subscribed to topic for this kind of message.
+        """
+        tables = []
+        if topic in self._topics:
+            tables.append(self._topics[topic])
+        if self._patterns:
+            self._match(self._wildcards, topic.split('.'), 0, tables)
+
+        recipients = dict()
+        for subscribers in tables:
+            for kind in (None, type(message)):
+                if kind in subscribers:
+                    recipients.update(subscribers[kind])
+        return recipients.values()
+
+    def send(self, sender, topic, message):
+        count = 0
+        for colleague in self.recipients(topic, message):
+            if colleague is not sender:
+                colleague.receive(sender, topic, message)
+                count += 1
+        return count
+
+
+class Mailbox(object):
+    """
+    A bounded queue of messages for one colleague, drained by its own
+    consumer thread, with the colleague's delivery metrics.
+    """
+    def __init__(self, colleague, maxsize):
+        self.colleague = colleague
+        self.messages = Queue.Queue(maxsize)
+        self.received = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._consume)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _consume(self):
+        while True:
+            item = self.messages.get()
+            if item is None:
+                self.messages.task_done()
+                return
+            sender, topic, message, sent = item
+            try:
+                self.colleague.receive(sender, topic, message)
+            except Exception:
+                self.failed += 1
+            latency = time.time() - sent
+            self.received += 1
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.messages.task_done()
+            if self._closed:
+                return
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Queues a message, waiting up to timeout seconds for room if block is
+        set. Returns False, and counts the message as dropped if it waited,
+        when the mailbox stayed full.
+        """
+        try:
+            self.messages.put(item, block, timeout)
+            return True
+        except Queue.Full:
+            if block:
+                with self._lock:
+                    self.dropped += 1
+            return False
+
+    def metrics(self):
+        return {
+            'depth': self.messages.qsize(),
+            'received': self.received,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'latency': self.latency / self.received if self.received else 0.0,
+            'max_latency': self.max_latency,
+        }
+
+    def close(self):
+        """
+        Stops the consumer thread once it has received the messages already
+        queued. From the consumer thread itself (a colleague unsubscribing
+        in receive()), it stops after the current message instead.
+        """
+        if threading.current_thread() is self._thread:
+            self._closed = True
+            return
+        self.messages.put(None)
+        self._thread.join()
+
+
+class ConcurrentMediator(ConcreteMediator):
+    """
+    Routes like ConcreteMediator, but colleagues run concurrently: each one
+    gets a mailbox of maxsize messages and a consumer thread that calls its
+    receive(). A send first queues the message for every recipient with
+    room, then waits for the full mailboxes, so a slow colleague holds back
+    the sender (backpressure) but not the other recipients. A send waits at
+    most timeout seconds for each full mailbox; messages still not queued
+    then are dropped and counted. With timeout None a send waits as long as
+    it takes, so a stalled colleague stalls every thread sending to it.
+
+    A colleague's mailbox and thread are stopped once it has unsubscribed
+    from every topic.
+    """
+    def __init__(self, maxsize=1024, timeout=1.0):
+        super(ConcurrentMediator, self).__init__()
+        self._maxsize = maxsize
+        self._timeout = timeout
+        self._mailboxes = dict()
+        self._subscriptions = dict()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def subscribe(self, colleague, topic, kind=None):
+        with self._lock:
+            if self._closed:
+                raise Exception('Mediator is closed')
+            if id(colleague) not in self._mailboxes:
+                self._mailboxes[id(colleague)] = Mailbox(colleague,
+                                                         self._maxsize)
+                self._subscriptions[id(colleague)] = set()
+            self._subscriptions[id(colleague)].add((topic, kind))
+            super(ConcurrentMediator, self).subscribe(colleague, topic, kind)
+
+    def unsubscribe(self, colleague, topic, kind=None):
+        with self._lock:
+            super(ConcurrentMediator, self).unsubscribe(colleague, topic, kind)
+            subscriptions = self._subscriptions.get(id(colleague))
+            if subscriptions is None:
+                return
+            subscriptions.discard((topic, kind))
+            if subscriptions:
+                return
+            del self._subscriptions[id(colleague)]
+            mailbox = self._mailboxes.pop(id(colleague))
+        mailbox.close()
+
+    def send(self, sender, topic, message):
+        item = (sender, topic, message, time.time())
+        full = []
+        count = 0
+        with self._lock:
+            if self._closed:
+                raise Exception('Mediator is closed')
+            mailboxes = [self._mailboxes[id(colleague)]
+                         for colleague in self.recipients(topic, message)
+                         if colleague is not sender]
+        for mailbox in mailboxes:
+            if mailbox.put(item, block=False):
+                count += 1
+            else:
+                full.append(mailbox)
+        for mailbox in full:
+            if mailbox.put(item, timeout=self._timeout):
+                count += 1
+        return count
+
+    def join(self):
+        """
+        Waits until every queued message has been received.
+        """
+        for mailbox in self._mailboxes.values():
+            mailbox.messages.join()
+
+    def metrics(self):
+        """
+        Returns the metrics of every colleague's mailbox.
+        """
+        return dict((m.colleague, m.metrics())
+                    for m in self._mailboxes.values())
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            mailboxes = self._mailboxes.values()
+            self._mailboxes.clear()
+            self._subscriptions.clear()
+        for mailbox in mailboxes:
+            mailbox.close()
 
 
 class Colleague(object):
@@ -31,18 +315,27 @@ class Colleague(object):
     2. Each Colleague communicates with its mediator whenever it would have
        otherwise communicated with another colleague.
     """
-    pass
+    def __init__(self, mediator):
+        self.mediator = mediator
+
+    def send(self, topic, message):
+        return self.mediator.send(self, topic, message)
+
+    def receive(self, sender, topic, message):
+        raise NotImplementedError
 
 
 class ConcreteColleague1(Colleague):
     """
     Implements the Colleague interface.
     """
-    pass
+    def receive(self, sender, topic, message):
+        print '%s got %r on %s' % (type(self).__name__, message, topic)
 
 
 class ConcreteColleague2(Colleague):
-    pass
+    def receive(self, sender, topic, message):
+        print '%s got %r on %s' % (type(self).__name__, message, topic)
 
 
 class Client(object):
@@ -50,9 +343,60 @@ class Client(object):
         # Colleagues send and receive requests from a Mediator object.
         # The mediator implements the cooperative behavior by routing requests
         # between the appropriate colleagues.
-        pass
+        mediator = ConcreteMediator()
+        c1 = ConcreteColleague1(mediator)
+        c2 = ConcreteColleague2(mediator)
+        mediator.subscribe(c1, 'orders.*.created')
+        mediator.subscribe(c2, 'orders.#', kind=int)
+        c2.send('orders.eu.created', 'new order')
+        c1.send('orders.eu.created', 42)
+
+        mediator = ConcurrentMediator(maxsize=16)
+        c1 = ConcreteColleague1(mediator)
+        c2 = ConcreteColleague2(mediator)
+        mediator.subscribe(c1, 'orders.#')
+        mediator.subscribe(c2, 'orders.#')
+        c1.send('orders.us.created', 'concurrent order')
+        mediator.join()
+        print mediator.metrics()[c2]
+        mediator.close()
+
+
+class Benchmark(object):
+    class Colleague(Colleague):
+        def receive(self, sender, topic, message):
+            self.received = message
+
+    def main(self, colleagues=10000, topics=1000, count=100000):
+        mediator = ConcreteMediator()
+        members = [self.Colleague(mediator) for n in xrange(colleagues)]
+        for n, colleague in enumerate(members):
+            colleague.topic = 'topic.%d' % (n % topics)
+            mediator.subscribe(colleague, colleague.topic)
+        mediator.subscribe(members[0], 'topic.#')
+        sends = ['topic.%d' % (n % topics) for n in xrange(count)]
+
+        def broadcast():
+            # Without an index: every colleague checks every message
+            for topic in sends[:count // 100]:
+                for colleague in members:
+                    if colleague.topic == topic:
+                        colleague.receive(None, topic, 'hello')
+
+        def route():
+            for topic in sends:
+                mediator.send(None, topic, 'hello')
+
+        for name, run, sent in [('broadcast', broadcast, count // 100),
+                                ('topic index', route, count)]:
+            elapsed = min(timeit.repeat(run, number=1, repeat=3))
+            print '%-12s %10.0f sends/s' % (name, sent / elapsed)
 
 
 if __name__ == '__main__':
-    c = Client()
-    c.main()
+    if '--benchmark' in sys.argv:
+        b = Benchmark()
+        b.main()
+    else:
+        c = Client()
+        c.main()